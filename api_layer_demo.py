@@ -1,12 +1,29 @@
-from typing import List, Dict
+import asyncio
+import base64
+import hashlib
+import hmac
+import os
+import threading
+import time
+from collections import defaultdict, deque, namedtuple
+from dataclasses import dataclass
+
+import httpx
+import orjson
+
+try:
+    import numpy as np
+except ImportError:  # vectorized batch FX is optional
+    np = None
+from cachetools import TTLCache
+from typing import List
 from fastapi import FastAPI, HTTPException, BackgroundTasks, Depends
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
-from jose import JWTError, jwt
 from datetime import timedelta, datetime
 from pydantic import BaseModel
 from typing import Optional
 from uuid import uuid4
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, ORJSONResponse, Response
 from fastapi.requests import Request
 
 # Model classes
@@ -27,33 +44,193 @@ class PaymentStatus(BaseModel):
     converted_amount: Optional[float] = None
     target_currency: Optional[str] = None
 
-# Adapter pattern for legacy CBS integration
+# Cached clock. _fmt_iso memoizes the strftime of the integer second and
+# only formats the fractional microseconds per call; _now_iso additionally
+# reuses the whole string for calls within the same millisecond. Together
+# they keep datetime construction and formatting off the hot paths.
+_fmt_cache = [-1, ""]
+
+def _fmt_iso(t):
+    sec = int(t)
+    if sec != _fmt_cache[0]:
+        _fmt_cache[0] = sec
+        _fmt_cache[1] = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(sec))
+    return f"{_fmt_cache[1]}.{int((t - sec) * 1e6):06d}"
+
+def _now_iso(_cache=[0.0, ""]):
+    t = time.time()
+    if t - _cache[0] < 0.001:
+        return _cache[1]
+    s = _fmt_iso(t)
+    _cache[0] = t
+    _cache[1] = s
+    return s
+
+# Flat per-payment record: slot reads instead of nested dict probes, and
+# roughly a third of the memory of the previous dict-of-dicts layout.
+@dataclass(slots=True)
+class PaymentRecord:
+    from_account: str
+    to_account: str
+    amount: float
+    currency: str
+    target_currency: Optional[str]
+    fx_rate: Optional[float]
+    converted_amount: Optional[float]
+    status: str
+    settlement_time: Optional[str]
+
+# Redis mirroring for the payments map (active when REDIS_URL is set):
+# writes go through to a per-payment Redis hash and local read misses fall
+# back to it, so state survives worker restarts and is visible across
+# workers while the in-process dict keeps serving warm reads.
+def _record_to_redis(rec):
+    return {
+        "from_account": rec.from_account,
+        "to_account": rec.to_account,
+        "amount": rec.amount,
+        "currency": rec.currency,
+        "target_currency": rec.target_currency or "",
+        "fx_rate": "" if rec.fx_rate is None else rec.fx_rate,
+        "converted_amount": "" if rec.converted_amount is None else rec.converted_amount,
+        "status": rec.status,
+        "settlement_time": rec.settlement_time or "",
+    }
+
+def _record_from_redis(data):
+    d = {k.decode(): v.decode() for k, v in data.items()}
+    return PaymentRecord(
+        from_account=d["from_account"],
+        to_account=d["to_account"],
+        amount=float(d["amount"]),
+        currency=d["currency"],
+        target_currency=d["target_currency"] or None,
+        fx_rate=float(d["fx_rate"]) if d["fx_rate"] else None,
+        converted_amount=float(d["converted_amount"]) if d["converted_amount"] else None,
+        status=d["status"],
+        settlement_time=d["settlement_time"] or None,
+    )
+
+# Payment id allocation: every uuid4() is its own getrandom syscall, so
+# ids are cut from larger os.urandom blocks instead -- a 256-id pool for
+# the single-payment path and one exact-sized block per batch.
+_ID_POOL_SIZE = 256
+_id_pool = []
+
+def _next_id():
+    if not _id_pool:
+        buf = os.urandom(16 * _ID_POOL_SIZE)
+        _id_pool.extend(buf[i:i + 16] for i in range(0, len(buf), 16))
+    return _id_pool.pop()
+
+def _alloc_ids(n):
+    buf = os.urandom(16 * n)
+    return [buf[i:i + 16] for i in range(0, 16 * n, 16)]
+
+# Adapter pattern for legacy CBS integration.
+# Writes are serialized through an asyncio.Lock (single writer per key);
+# reads stay lock-free since dict .get is atomic under the GIL.
 class LegacyCBSAdapter:
     def __init__(self):
         self.payments = {}
-
-    def initiate_payment(self, req):
-        payment_id = str(uuid4())
+        # Serialized responses for terminal states: once a payment settles
+        # its status response never changes, so cache the encoded bytes and
+        # let reads skip Pydantic and JSON encoding entirely.
+        self._final = {}
+        # Reverse index for per-user listings: maintained on write so reads
+        # never scan the full payments map.
+        self._by_user = defaultdict(set)
+        self._lock = asyncio.Lock()
+
+    async def initiate_payment(self, req, fx_rate=None, converted_amount=None, user=None):
+        return await self.initiate_payment_with_id(_next_id(), req, fx_rate, converted_amount, user)
+
+    async def initiate_payment_with_id(self, payment_id, req, fx_rate=None, converted_amount=None, user=None):
+        # 16-byte keys: half the footprint of the 32-char hex form and a
+        # faster builtin hash; callers expose .hex() at the API boundary.
         # Simulate legacy CBS logic (replace with real CBS API call)
-        self.payments[payment_id] = {
-            "request": req.dict(),
-            "status": "pending",
-            "settlement_time": None
-        }
+        record = PaymentRecord(
+            from_account=req.from_account,
+            to_account=req.to_account,
+            amount=req.amount,
+            currency=req.currency,
+            target_currency=req.target_currency,
+            fx_rate=fx_rate,
+            converted_amount=converted_amount,
+            status="pending",
+            settlement_time=None
+        )
+        async with self._lock:
+            self.payments[payment_id] = record
+            if user is not None:
+                self._by_user[user].add(payment_id)
+        if _redis is not None:
+            await _redis.hset(f"payments:{payment_id.hex()}", mapping=_record_to_redis(record))
         return payment_id
 
-    def get_status(self, payment_id):
+    async def get_status(self, payment_id):
         payment = self.payments.get(payment_id)
-        if not payment:
-            return None
+        if payment is None and _redis is not None:
+            # Miss in the local L1: rehydrate from the Redis mirror (e.g.
+            # another worker created the payment, or this worker restarted).
+            data = await _redis.hgetall(f"payments:{payment_id.hex()}")
+            if data:
+                payment = _record_from_redis(data)
+                self.payments[payment_id] = payment
         return payment
 
-    def settle_payment(self, payment_id):
-        payment = self.payments.get(payment_id)
-        if not payment:
-            return None
-        payment["status"] = "settled"
-        payment["settlement_time"] = datetime.utcnow().isoformat()
+    async def begin_settle(self, payment_id):
+        # Single lookup for the settle request path: atomically transition
+        # pending -> settling and return the record, so the handler does not
+        # probe the map once for existence and again for the write. The
+        # started flag distinguishes a double settlement from a miss.
+        if payment_id not in self.payments and _redis is not None:
+            # Same read-through as get_status: the payment may have been
+            # initiated by another worker or before a restart. setdefault so
+            # a concurrent rehydrate cannot replace the record mid-settle.
+            data = await _redis.hgetall(f"payments:{payment_id.hex()}")
+            if data:
+                self.payments.setdefault(payment_id, _record_from_redis(data))
+        async with self._lock:
+            payment = self.payments.get(payment_id)
+            started = payment is not None and payment.status == "pending"
+            if started:
+                payment.status = "settling"
+        if started and _redis is not None:
+            # Claim the transition in the mirror before reporting it started:
+            # HSETNX is atomic, so when two workers race past their local
+            # pending checks only the first claim wins and the loser takes
+            # the conflict path. Local status stays "settling" either way --
+            # the payment is settling, just not necessarily on this worker.
+            claimed = await _redis.hsetnx(f"payments:{payment_id.hex()}", "settle_claim", "1")
+            if claimed:
+                await _redis.hset(f"payments:{payment_id.hex()}", "status", "settling")
+            else:
+                started = False
+        return payment, started
+
+    async def settle_payment(self, payment_id):
+        async with self._lock:
+            payment = self.payments.get(payment_id)
+            if not payment:
+                return None
+            payment.status = "settled"
+            payment.settlement_time = _now_iso()
+            self._final[payment_id] = orjson.dumps(PaymentStatus.model_construct(
+                payment_id=payment_id.hex(),
+                status=payment.status,
+                settlement_time=payment.settlement_time,
+                amount=payment.amount,
+                currency=payment.currency,
+                fx_rate=payment.fx_rate,
+                converted_amount=payment.converted_amount,
+                target_currency=payment.target_currency or payment.currency
+            ).model_dump())
+        if _redis is not None:
+            await _redis.hset(
+                f"payments:{payment_id.hex()}",
+                mapping={"status": payment.status, "settlement_time": payment.settlement_time}
+            )
         return payment
     
 class WebhookRegistration(BaseModel):
@@ -63,29 +240,43 @@ class WebhookRegistration(BaseModel):
 class BatchPaymentRequest(BaseModel):
     payments: List[PaymentRequest]
 
-class BatchPaymentResult(BaseModel):
-    results: List[Dict]
-    summary: Dict
-
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse)
 
-# Reconciliation endpoint
+def _decode_payment_id(payment_id):
+    # Payment ids travel as 32-char hex; reject malformed ids before any
+    # dict lookup and use the 16-byte form as the internal key.
+    try:
+        pid = bytes.fromhex(payment_id)
+    except ValueError:
+        pid = b""
+    if len(pid) != 16:
+        raise HTTPException(status_code=400, detail="Invalid payment id")
+    return pid
+
+# Reconciliation endpoint. One comprehension pass over the slotted records:
+# each row is eight C-level slot reads into a dict literal, no append method
+# dispatch or incremental list growth per row.
 @app.get("/v1/payments/reconciliation")
-def reconciliation():
-    all_payments = []
-    for pid, pdata in cbs_adapter.payments.items():
-        req = pdata["request"]
-        all_payments.append({
-            "payment_id": pid,
-            "from_account": req["from_account"],
-            "to_account": req["to_account"],
-            "amount": req["amount"],
-            "currency": req["currency"],
-            "target_currency": req.get("target_currency"),
-            "status": pdata["status"],
-            "settlement_time": pdata["settlement_time"]
-        })
-    return {"payments": all_payments, "count": len(all_payments)}
+async def reconciliation():
+    all_payments = [
+        {
+            "payment_id": pid.hex(),
+            "from_account": rec.from_account,
+            "to_account": rec.to_account,
+            "amount": rec.amount,
+            "currency": rec.currency,
+            "target_currency": rec.target_currency,
+            "status": rec.status,
+            "settlement_time": rec.settlement_time
+        }
+        for pid, rec in cbs_adapter.payments.items()
+    ]
+    # Encode here and return raw bytes: skips FastAPI's jsonable_encoder
+    # pass over what can be thousands of rows.
+    return Response(
+        content=orjson.dumps({"payments": all_payments, "count": len(all_payments)}),
+        media_type="application/json"
+    )
 
 # Global error handler for clearer error responses
 @app.exception_handler(Exception)
@@ -101,24 +292,152 @@ cbs_adapter = LegacyCBSAdapter()
 # Webhook registry (in-memory for demo)
 webhooks = {}
 
-# Audit log (in-memory for demo)
-audit_log = []
+# Shared HTTP client for webhook delivery: keep-alive pool avoids a fresh
+# TCP+TLS handshake per delivery, and async POSTs run on the event loop
+# instead of tying up threadpool workers.
+_http = httpx.AsyncClient(
+    timeout=5.0,
+    limits=httpx.Limits(max_keepalive_connections=100),
+)
+
+@app.on_event("shutdown")
+async def close_http_client():
+    await _http.aclose()
+
+# Webhook batching: settlements enqueue events and a single drainer task
+# flushes everything currently queued as one JSON array per subscriber URL,
+# amortizing TLS/HTTP overhead across the backlog (queue-batching, not
+# wait-batching -- an empty queue flushes immediately).
+WEBHOOK_BATCH_TIMEOUT_SECONDS = float(os.environ.get("WEBHOOK_BATCH_TIMEOUT_SECONDS", "5"))
+WEBHOOK_BATCH_SIZE_LIMIT_BYTES = int(os.environ.get("WEBHOOK_BATCH_SIZE_LIMIT_BYTES", str(1024 * 1024)))
+
+_wh_queue: asyncio.Queue = None
+
+@app.on_event("startup")
+async def start_webhook_drainer():
+    global _wh_queue
+    _wh_queue = asyncio.Queue()
+    asyncio.create_task(_drain_webhooks())
+
+async def _drain_webhooks():
+    while True:
+        event = await _wh_queue.get()
+        # Deduplicate by payment_id: the latest queued status wins, and plain
+        # dict keeps insertion order, so fewer bytes hit the wire when a
+        # payment transitions several times within one batch. Each event is
+        # encoded once here; the same bytes size the batch and build the body.
+        enc = orjson.dumps(event)
+        pending = {event["payment_id"]: (event["payment_id"], enc)}
+        started = time.monotonic()
+        size = len(enc)
+        # Pull whatever else is already queued, bounded by size and time
+        while size < WEBHOOK_BATCH_SIZE_LIMIT_BYTES and time.monotonic() - started < WEBHOOK_BATCH_TIMEOUT_SECONDS:
+            try:
+                event = _wh_queue.get_nowait()
+            except asyncio.QueueEmpty:
+                break
+            enc = orjson.dumps(event)
+            pending[event["payment_id"]] = (event["payment_id"], enc)
+            size += len(enc)
+        # Group by subscriber URL and ship each batch over one connection
+        batches = {}
+        for pid, enc in pending.values():
+            url = webhooks.get(pid)
+            if url:
+                batches.setdefault(url, []).append((pid, enc))
+        for url, batch in batches.items():
+            await _post_webhook_batch(url, batch)
+
+async def _post_webhook_batch(url, batch, max_retries=3):
+    # batch is a list of (payment_id, encoded_event_bytes); the JSON array
+    # body is stitched from the pre-encoded events.
+    body = b"[" + b",".join(enc for _, enc in batch) + b"]"
+    delay = 1
+    for attempt in range(max_retries):
+        try:
+            await _http.post(
+                url,
+                content=body,
+                headers={"content-type": "application/json"},
+                timeout=3,
+            )
+            return True
+        except Exception:
+            await asyncio.sleep(delay)
+            delay *= 2  # Exponential backoff
+    # Log failed webhook delivery
+    log_action(None, "webhook_failed", {"url": url, "payment_ids": [pid for pid, _ in batch]})
+    return False
 
-# Metrics (in-memory for demo)
-metrics = {
-    "total_requests": 0,
-    "successful_payments": 0,
-    "rate_limit_hits": 0,
-    "fraud_blocks": 0,
-}
+# Audit log (in-memory for demo). Requests enqueue raw entries with an
+# integer nanosecond clock read; a background drainer formats timestamps
+# and appends to a bounded deque, so the request path does no datetime
+# work and memory stays capped.
+audit_log = deque(maxlen=100_000)
+_audit_q = asyncio.Queue(maxsize=100_000)
+
+# Entries rotated out of the in-memory deque survive on disk: each drained
+# batch is also appended as JSON lines with a single writelines call, run
+# in the default executor so the event loop never blocks on file I/O.
+AUDIT_LOG_PATH = os.environ.get("AUDIT_LOG_PATH", "audit.log")
+_audit_file = None
+
+def _write_audit_lines(lines):
+    global _audit_file
+    if _audit_file is None:
+        _audit_file = open(AUDIT_LOG_PATH, "ab")
+    _audit_file.writelines(lines)
+    _audit_file.flush()
+
+@app.on_event("startup")
+async def start_audit_drainer():
+    asyncio.create_task(_audit_drain())
+
+async def _audit_drain():
+    while True:
+        entry = await _audit_q.get()
+        batch = [entry]
+        while len(batch) < 1000:
+            try:
+                batch.append(_audit_q.get_nowait())
+            except asyncio.QueueEmpty:
+                break
+        entries = [
+            {"timestamp": _fmt_iso(e.ts / 1e9), "user": e.user, "action": e.action, "details": e.details}
+            for e in batch
+        ]
+        audit_log.extend(entries)
+        lines = [orjson.dumps(e) + b"\n" for e in entries]
+        await asyncio.get_running_loop().run_in_executor(None, _write_audit_lines, lines)
+
+# Metrics (in-memory for demo): plain module-level ints so an increment is
+# one global rebind instead of two dict hashes; /v1/metrics builds the view.
+_total_requests = 0
+_successful_payments = 0
+_rate_limit_hits = 0
+_fraud_blocks = 0
+
+def _log_payload(req):
+    # Static field access instead of model_dump: no validator walk, no copy
+    # of a full model dump just to splat five known fields into the entry.
+    return {
+        "from_account": req.from_account,
+        "to_account": req.to_account,
+        "amount": req.amount,
+        "currency": req.currency,
+        "target_currency": req.target_currency
+    }
+
+# Hot-path audit record: a 4-slot tuple of shared refs instead of a fresh
+# envelope dict per event; the dict form lives only in the drainer, where
+# readers (the deque and the disk flush) actually need it.
+AuditEntry = namedtuple("AuditEntry", "ts user action details")
 
 def log_action(user, action, details):
-    audit_log.append({
-        "timestamp": datetime.utcnow().isoformat(),
-        "user": user,
-        "action": action,
-        "details": details
-    })
+    try:
+        _audit_q.put_nowait(AuditEntry(time.time_ns(), user, action, details))
+    except asyncio.QueueFull:
+        pass  # shed audit entries rather than block the request path
 
 # JWT config
 SECRET_KEY = "demo_secret_key_change_me"
@@ -126,52 +445,146 @@ ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/api/token")
 
+SECRET_KEY_BYTES = SECRET_KEY.encode()
+# The HS256 header never changes, so its base64 form is computed once at
+# import; issuance is then orjson + one HMAC + two base64 encodes with no
+# library dispatch or header re-serialization per token.
+_JWT_HEADER = base64.urlsafe_b64encode(b'{"alg":"HS256","typ":"JWT"}').rstrip(b"=")
+
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
     if expires_delta:
-        expire = datetime.utcnow() + expires_delta
+        expire = int(time.time() + expires_delta.total_seconds())
     else:
-        expire = datetime.utcnow() + timedelta(minutes=15)
-    to_encode.update({"exp": expire})
-    return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
-
-def get_current_user(token: str = Depends(oauth2_scheme)):
+        expire = int(time.time()) + 15 * 60
+    to_encode["exp"] = expire
+    payload_b64 = base64.urlsafe_b64encode(orjson.dumps(to_encode)).rstrip(b"=")
+    signing_input = _JWT_HEADER + b"." + payload_b64
+    sig = hmac.new(SECRET_KEY_BYTES, signing_input, hashlib.sha256).digest()
+    return (signing_input + b"." + base64.urlsafe_b64encode(sig).rstrip(b"=")).decode()
+
+def _decode_hs256(token):
+    # Counterpart of the hand-rolled issuance above: constant-time HMAC
+    # check, then orjson for the claims, so the (cache-miss) decode path
+    # does no stdlib-json work. Returns the claims or None when the token
+    # is malformed, mis-signed, wrong-alg or expired.
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        username = payload.get("sub")
-        if username is None:
-            raise HTTPException(status_code=401, detail="Invalid credentials")
-        return username
-    except JWTError:
+        signing_input, _, sig_b64 = token.rpartition(".")
+        expected = hmac.new(SECRET_KEY_BYTES, signing_input.encode(), hashlib.sha256).digest()
+        sig = base64.urlsafe_b64decode(sig_b64 + "=" * (-len(sig_b64) % 4))
+        if not hmac.compare_digest(sig, expected):
+            return None
+        header_b64, _, payload_b64 = signing_input.partition(".")
+        header = orjson.loads(base64.urlsafe_b64decode(header_b64 + "=" * (-len(header_b64) % 4)))
+        if header.get("alg") != ALGORITHM:
+            return None
+        claims = orjson.loads(base64.urlsafe_b64decode(payload_b64 + "=" * (-len(payload_b64) % 4)))
+        if claims.get("exp", 0) <= time.time():
+            return None
+        return claims
+    except ValueError:
+        return None
+
+# Decoded-token cache: HMAC verification runs once per distinct token
+# string; repeat requests become a dict lookup plus an expiry check.
+# For multi-process deployments swap this for a shared Redis cache.
+_jwt_cache = TTLCache(maxsize=10_000, ttl=ACCESS_TOKEN_EXPIRE_MINUTES * 60)
+_jwt_cache_lock = threading.Lock()
+
+# One-slot fast path for the hot-token case: a tight client reusing one
+# keep-alive connection sends the same bearer token back-to-back, so one
+# string compare answers most requests before the LRU is touched. The
+# compare is == rather than is because the header parser builds a fresh
+# str object per request, so identity would never match.
+_last_token = None
+_last_user = None
+_last_exp = 0.0
+
+async def get_current_user(token: str = Depends(oauth2_scheme)):
+    global _last_token, _last_user, _last_exp
+    if token == _last_token and _last_exp > time.time():
+        return _last_user
+    with _jwt_cache_lock:
+        hit = _jwt_cache.get(token)
+    if hit is not None:
+        if hit[1] > time.time():
+            _last_token, _last_user, _last_exp = token, hit[0], hit[1]
+            return hit[0]
+        # Token outlived its exp claim before the cache TTL did; evict
+        # lazily so the retry below surfaces the usual 401.
+        with _jwt_cache_lock:
+            _jwt_cache.pop(token, None)
+    payload = _decode_hs256(token)
+    if payload is None:
         raise HTTPException(status_code=401, detail="Invalid credentials")
+    username = payload.get("sub")
+    if username is None:
+        raise HTTPException(status_code=401, detail="Invalid credentials")
+    exp = payload.get("exp", 0)
+    with _jwt_cache_lock:
+        _jwt_cache[token] = (username, exp)
+    _last_token, _last_user, _last_exp = token, username, exp
+    return username
+
+# Per-user payment listing backed by the adapter's reverse index
+@app.get("/v1/users/{username}/payments")
+async def list_user_payments(username: str, user: str = Depends(get_current_user)):
+    payment_ids = [pid.hex() for pid in cbs_adapter._by_user.get(username, ())]
+    log_action(user, "list_user_payments", {"username": username, "count": len(payment_ids)})
+    return {"user": username, "payment_ids": payment_ids, "count": len(payment_ids)}
 
 # Batch payments endpoint
-@app.post("/v1/payments/batch", response_model=BatchPaymentResult)
-def batch_payments(batch: BatchPaymentRequest, user: str = Depends(get_current_user)):
+@app.post("/v1/payments/batch")
+async def batch_payments(batch: BatchPaymentRequest, user: str = Depends(get_current_user)):
+    payments = batch.payments
+    # Resolve each distinct currency pair once for the whole batch
+    pairs = {(r.currency, r.target_currency) for r in payments if r.target_currency and r.target_currency != r.currency}
+    rates = {p: get_fx_rate(p) for p in pairs}
+    # For large batches do the multiply-and-round of every converting row in
+    # one vectorized pass; rows with a missing rate carry NaN and are
+    # rejected by the per-row branch before the value is used.
+    ids = _alloc_ids(len(payments))
+    converted = None
+    if np is not None and len(payments) >= 32:
+        amounts = np.fromiter((r.amount for r in payments), dtype=np.float64, count=len(payments))
+        rate_arr = np.fromiter(
+            (
+                (rates[(r.currency, r.target_currency)] or float("nan"))
+                if r.target_currency and r.target_currency != r.currency
+                else 1.0
+                for r in payments
+            ),
+            dtype=np.float64,
+            count=len(payments),
+        )
+        converted = np.round(amounts * rate_arr, 2).tolist()
     results = []
     success = 0
     failed = 0
-    for req in batch.payments:
-        try:
-            # Reuse single payment logic
+    for i, req in enumerate(payments):
+        # One payload per row, shared by the audit entry and the error
+        # branch; a missing rate is an explicit branch rather than a raised
+        # and caught exception per bad row.
+        d = _log_payload(req)
+        target_currency = req.target_currency or req.currency
+        if req.target_currency and req.target_currency != req.currency:
+            fx_rate = rates[(req.currency, req.target_currency)]
+            if fx_rate is None:
+                results.append({"error": "FX rate not available", "payment": d})
+                failed += 1
+                continue
+            converted_amount = converted[i] if converted is not None else round(req.amount * fx_rate, 2)
+        else:
             fx_rate = None
-            converted_amount = None
-            target_currency = req.target_currency or req.currency
-            if req.target_currency and req.target_currency != req.currency:
-                fx_rate = get_fx_rate(req.currency, req.target_currency)
-                if fx_rate is None:
-                    raise Exception("FX rate not available")
-                converted_amount = round(req.amount * fx_rate, 2)
-            else:
-                converted_amount = req.amount
-            payment_id = cbs_adapter.initiate_payment(req)
-            log_action(user, "batch_initiate_payment", {"payment_id": payment_id, **req.dict(), "fx_rate": fx_rate, "converted_amount": converted_amount, "target_currency": target_currency})
-            results.append({"payment_id": payment_id, "status": "pending", "amount": req.amount, "currency": req.currency, "converted_amount": converted_amount, "target_currency": target_currency})
-            success += 1
-        except Exception as e:
-            results.append({"error": str(e), "payment": req.dict()})
-            failed += 1
-    return BatchPaymentResult(results=results, summary={"success": success, "failed": failed, "total": len(batch.payments)})
+            converted_amount = req.amount
+        payment_id = (await cbs_adapter.initiate_payment_with_id(ids[i], req, fx_rate, converted_amount, user)).hex()
+        log_action(user, "batch_initiate_payment", {"payment_id": payment_id, **d, "fx_rate": fx_rate, "converted_amount": converted_amount, "target_currency": target_currency})
+        results.append({"payment_id": payment_id, "status": "pending", "amount": req.amount, "currency": req.currency, "converted_amount": converted_amount, "target_currency": target_currency})
+        success += 1
+    return Response(
+        content=orjson.dumps({"results": results, "summary": {"success": success, "failed": failed, "total": len(batch.payments)}}),
+        media_type="application/json"
+    )
 
 # Simple FX rates table (for demo)
 FX_RATES = {
@@ -183,42 +596,111 @@ FX_RATES = {
     ("GBP", "EUR"): 1.15,
 }
 
-def get_fx_rate(src, tgt):
-    if src == tgt:
-        return 1.0
-    return FX_RATES.get((src, tgt), None)
-
-@app.post("/v1/payments", response_model=PaymentStatus)
-def initiate_payment(req: PaymentRequest, user: str = Depends(get_current_user)):
-    import time
-    metrics["total_requests"] += 1
+# Identity pairs are added at import so same-currency lookups are one
+# dict hit like any other, and get_fx_rate can be bound straight to the
+# C-level dict .get, with no Python call frame or branch per lookup.
+# Callers pass the (src, tgt) tuple directly. Unlisted pairs stay None:
+# cross rates are quoted data, not something to derive here.
+for _c in {c for pair in FX_RATES for c in pair}:
+    FX_RATES[(_c, _c)] = 1.0
+
+get_fx_rate = FX_RATES.get
+
+# Rate limiting: per-user sliding window kept in a bounded deque so
+# eviction is amortized O(1) pops from the left instead of rebuilding a
+# list per request. time.monotonic avoids wall-clock jumps.
+RATE_LIMIT = 10  # max requests per minute per user
+WINDOW = 60  # seconds
+_user_requests = defaultdict(lambda: deque(maxlen=RATE_LIMIT))
+
+# With REDIS_URL set, the window lives in a Redis sorted set updated by one
+# atomic Lua script (ZREMRANGEBYSCORE + ZCARD + conditional ZADD), so N
+# uvicorn workers share a single limit instead of each allowing RATE_LIMIT.
+# Without it, the in-process deque above is the per-worker fallback.
+REDIS_URL = os.environ.get("REDIS_URL")
+if REDIS_URL:
+    import redis.asyncio as aioredis
+    _redis = aioredis.from_url(REDIS_URL)
+else:
+    _redis = None
+
+_RL_SCRIPT = """
+local key = KEYS[1]
+local now = tonumber(ARGV[1])
+local window = tonumber(ARGV[2])
+local limit = tonumber(ARGV[3])
+redis.call('ZREMRANGEBYSCORE', key, 0, now - window)
+local count = redis.call('ZCARD', key)
+if count < limit then
+    redis.call('ZADD', key, now, ARGV[4])
+    redis.call('EXPIRE', key, window)
+end
+return count
+"""
+_rl_sha = None
+
+@app.on_event("startup")
+async def load_rate_limit_script():
+    global _rl_sha
+    if _redis is not None:
+        _rl_sha = await _redis.script_load(_RL_SCRIPT)
+
+async def check_rate_limit(user):
+    # Returns the request count already inside the window; the caller
+    # rejects when it is at or over RATE_LIMIT.
+    if _redis is not None:
+        return await _redis.evalsha(
+            _rl_sha, 1, f"rl:{user}", time.time(), WINDOW, RATE_LIMIT, uuid4().hex
+        )
+    now = time.monotonic()
+    dq = _user_requests[user]
+    while dq and now - dq[0] >= WINDOW:
+        dq.popleft()
+    count = len(dq)
+    if count < RATE_LIMIT:
+        dq.append(now)
+    return count
+
+# Fraud screening: the deny-list is compiled into an Aho-Corasick
+# automaton when pyahocorasick is installed, so the account string is
+# scanned once against all patterns instead of checked per entry -- a
+# realistic deny-list holds thousands of fragments. The fallback scans
+# the same fragments with `in` so the verdict for a given account is
+# identical whether or not the package is installed.
+FRAUD_AMOUNT = 10000.0  # flag payments over this amount
+SUSPICIOUS_ACCOUNTS = frozenset({"FAKE123", "TEST999"})
+try:
+    import ahocorasick
+
+    _suspicious_automaton = ahocorasick.Automaton()
+    for _acct in SUSPICIOUS_ACCOUNTS:
+        _suspicious_automaton.add_word(_acct, _acct)
+    _suspicious_automaton.make_automaton()
+
+    def _is_suspicious_account(account):
+        return any(True for _ in _suspicious_automaton.iter(account))
+except ImportError:
+    def _is_suspicious_account(account):
+        return any(frag in account for frag in SUSPICIOUS_ACCOUNTS)
+
+@app.post("/v1/payments")
+async def initiate_payment(req: PaymentRequest, user: str = Depends(get_current_user)):
+    global _total_requests, _rate_limit_hits, _fraud_blocks, _successful_payments
+    _total_requests += 1
     # --- Rate limiting ---
-    RATE_LIMIT = 10  # max requests per minute per user
-    WINDOW = 60  # seconds
-    if not hasattr(initiate_payment, "user_requests"):
-        initiate_payment.user_requests = {}
-    now = time.time()
-    user_reqs = initiate_payment.user_requests.setdefault(user, [])
-    # Remove requests older than WINDOW
-    user_reqs = [t for t in user_reqs if now - t < WINDOW]
-    if len(user_reqs) >= RATE_LIMIT:
-        metrics["rate_limit_hits"] += 1
-        log_action(user, "rate_limit_exceeded", {"count": len(user_reqs)})
+    count = await check_rate_limit(user)
+    if count >= RATE_LIMIT:
+        _rate_limit_hits += 1
+        log_action(user, "rate_limit_exceeded", {"count": count})
         raise HTTPException(status_code=429, detail="Rate limit exceeded. Try again later.")
-    user_reqs.append(now)
-    initiate_payment.user_requests[user] = user_reqs
-
-    # --- Fraud detection ---
-    FRAUD_AMOUNT = 10000.0  # flag payments over this amount
-    SUSPICIOUS_ACCOUNTS = {"FAKE123", "TEST999"}
-    fraud_flags = []
-    if req.amount > FRAUD_AMOUNT:
-        fraud_flags.append("high_amount")
-    if req.to_account in SUSPICIOUS_ACCOUNTS:
-        fraud_flags.append("suspicious_account")
-    if fraud_flags:
-        metrics["fraud_blocks"] += 1
-        log_action(user, "fraud_detected", {"flags": fraud_flags, **req.dict()})
+
+    # --- Fraud detection --- (no list allocation in the clean common case)
+    high = req.amount > FRAUD_AMOUNT
+    susp = _is_suspicious_account(req.to_account)
+    if high or susp:
+        fraud_flags = [f for f, v in (("high_amount", high), ("suspicious_account", susp)) if v]
+        _fraud_blocks += 1
+        log_action(user, "fraud_detected", {"flags": fraud_flags, **_log_payload(req)})
         raise HTTPException(status_code=403, detail=f"Fraud detected: {', '.join(fraud_flags)}")
 
     # --- FX conversion ---
@@ -226,131 +708,128 @@ def initiate_payment(req: PaymentRequest, user: str = Depends(get_current_user))
     converted_amount = None
     target_currency = req.target_currency or req.currency
     if req.target_currency and req.target_currency != req.currency:
-        fx_rate = get_fx_rate(req.currency, req.target_currency)
+        fx_rate = get_fx_rate((req.currency, req.target_currency))
         if fx_rate is None:
-            log_action(user, "initiate_payment_failed", {"reason": "FX rate not found", **req.dict()})
+            log_action(user, "initiate_payment_failed", {"reason": "FX rate not found", **_log_payload(req)})
             raise HTTPException(status_code=400, detail="FX rate not available for requested currency pair")
         converted_amount = round(req.amount * fx_rate, 2)
     else:
         converted_amount = req.amount
-    payment_id = cbs_adapter.initiate_payment(req)
-    metrics["successful_payments"] += 1
-    log_action(user, "initiate_payment", {"payment_id": payment_id, **req.dict(), "fx_rate": fx_rate, "converted_amount": converted_amount, "target_currency": target_currency})
-    return PaymentStatus(
-        payment_id=payment_id,
-        status="pending",
-        amount=req.amount,
-        currency=req.currency,
-        fx_rate=fx_rate,
-        converted_amount=converted_amount,
-        target_currency=target_currency
-    )
+    payment_id = (await cbs_adapter.initiate_payment(req, fx_rate, converted_amount, user)).hex()
+    _successful_payments += 1
+    log_action(user, "initiate_payment", {"payment_id": payment_id, **_log_payload(req), "fx_rate": fx_rate, "converted_amount": converted_amount, "target_currency": target_currency})
+    return {
+        "payment_id": payment_id,
+        "status": "pending",
+        "settlement_time": None,
+        "amount": req.amount,
+        "currency": req.currency,
+        "fx_rate": fx_rate,
+        "converted_amount": converted_amount,
+        "target_currency": target_currency
+    }
 # Token endpoint for demo (single user: demo/demo)
 @app.get("/v1/metrics")
-def get_metrics():
-    return metrics
+async def get_metrics():
+    return Response(
+        content=orjson.dumps({
+            "total_requests": _total_requests,
+            "successful_payments": _successful_payments,
+            "rate_limit_hits": _rate_limit_hits,
+            "fraud_blocks": _fraud_blocks,
+        }),
+        media_type="application/json"
+    )
 
-@app.get("/v1/payments/{payment_id}/status", response_model=PaymentStatus)
+@app.get("/v1/payments/{payment_id}/status")
 
-def check_status(payment_id: str, user: str = Depends(get_current_user)):
-    payment = cbs_adapter.get_status(payment_id)
+async def check_status(payment_id: str, user: str = Depends(get_current_user)):
+    pid = _decode_payment_id(payment_id)
+    # Terminal states return the pre-serialized snapshot directly
+    cached = cbs_adapter._final.get(pid)
+    if cached is not None:
+        log_action(user, "check_status", {"payment_id": payment_id, "status": "settled"})
+        return Response(content=cached, media_type="application/json")
+    payment = await cbs_adapter.get_status(pid)
     if not payment:
         log_action(user, "check_status_failed", {"payment_id": payment_id})
         raise HTTPException(status_code=404, detail="Payment not found")
-    req = payment["request"]
-    fx_rate = None
-    converted_amount = None
-    target_currency = req.get("target_currency") or req["currency"]
-    if req.get("target_currency") and req["currency"] != req["target_currency"]:
-        fx_rate = get_fx_rate(req["currency"], req["target_currency"])
-        converted_amount = round(req["amount"] * fx_rate, 2) if fx_rate else None
-    else:
-        converted_amount = req["amount"]
-    log_action(user, "check_status", {"payment_id": payment_id, "status": payment["status"]})
-    return PaymentStatus(
-        payment_id=payment_id,
-        status=payment["status"],
-        settlement_time=payment["settlement_time"],
-        amount=req["amount"],
-        currency=req["currency"],
-        fx_rate=fx_rate,
-        converted_amount=converted_amount,
-        target_currency=target_currency
-    )
-
-def send_webhook(payment_id, status, settlement_time, max_retries=3):
-    import requests
-    import time
-    url = webhooks.get(payment_id)
-    if url:
-        delay = 1
-        for attempt in range(max_retries):
-            try:
-                requests.post(url, json={
-                    "payment_id": payment_id,
-                    "status": status,
-                    "settlement_time": settlement_time
-                }, timeout=3)
-                return True
-            except Exception as e:
-                time.sleep(delay)
-                delay *= 2  # Exponential backoff
-        # Log failed webhook delivery
-        audit_log.append({
-            "timestamp": datetime.utcnow().isoformat(),
-            "user": None,
-            "action": "webhook_failed",
-            "details": {"payment_id": payment_id, "url": url, "status": status}
-        })
-    return False
+    fx_rate = payment.fx_rate
+    converted_amount = payment.converted_amount
+    target_currency = payment.target_currency or payment.currency
+    log_action(user, "check_status", {"payment_id": payment_id, "status": payment.status})
+    return {
+        "payment_id": payment_id,
+        "status": payment.status,
+        "settlement_time": payment.settlement_time,
+        "amount": payment.amount,
+        "currency": payment.currency,
+        "fx_rate": fx_rate,
+        "converted_amount": converted_amount,
+        "target_currency": target_currency
+    }
+
+def send_webhook(payment_id, status, settlement_time):
+    # Delivery happens in _drain_webhooks; this just enqueues the event.
+    _wh_queue.put_nowait({
+        "payment_id": payment_id,
+        "status": status,
+        "settlement_time": settlement_time
+    })
 
-@app.post("/v1/payments/{payment_id}/settle", response_model=PaymentStatus)
+@app.post("/v1/payments/{payment_id}/settle")
 
 
-def instant_settle(payment_id: str, background_tasks: BackgroundTasks, user: str = Depends(get_current_user)):
-    payment = cbs_adapter.get_status(payment_id)
+async def instant_settle(payment_id: str, background_tasks: BackgroundTasks, user: str = Depends(get_current_user)):
+    pid = _decode_payment_id(payment_id)
+    payment, started = await cbs_adapter.begin_settle(pid)
     if not payment:
         log_action(user, "instant_settle_failed", {"payment_id": payment_id})
         raise HTTPException(status_code=404, detail="Payment not found")
-    req = payment["request"]
-    fx_rate = None
-    converted_amount = None
-    target_currency = req.get("target_currency") or req["currency"]
-    if req.get("target_currency") and req["currency"] != req["target_currency"]:
-        fx_rate = get_fx_rate(req["currency"], req["target_currency"])
-        converted_amount = round(req["amount"] * fx_rate, 2) if fx_rate else None
-    else:
-        converted_amount = req["amount"]
-    # Simulate async settlement
-    def async_settle():
-        settled = cbs_adapter.settle_payment(payment_id)
+    if not started:
+        log_action(user, "instant_settle_conflict", {"payment_id": payment_id, "status": payment.status})
+        raise HTTPException(status_code=409, detail="Payment already settling or settled")
+    fx_rate = payment.fx_rate
+    converted_amount = payment.converted_amount
+    target_currency = payment.target_currency or payment.currency
+    # Simulate async settlement; async callables run on the event loop directly
+    async def async_settle():
+        settled = await cbs_adapter.settle_payment(pid)
         if settled:
-            log_action(user, "instant_settle", {"payment_id": payment_id, "status": settled["status"], "settlement_time": settled["settlement_time"], "fx_rate": fx_rate, "converted_amount": converted_amount, "target_currency": target_currency})
-            send_webhook(payment_id, settled["status"], settled["settlement_time"])
+            log_action(user, "instant_settle", {"payment_id": payment_id, "status": settled.status, "settlement_time": settled.settlement_time, "fx_rate": fx_rate, "converted_amount": converted_amount, "target_currency": target_currency})
+            send_webhook(payment_id, settled.status, settled.settlement_time)
     background_tasks.add_task(async_settle)
     log_action(user, "instant_settle_requested", {"payment_id": payment_id})
-    return PaymentStatus(
-        payment_id=payment_id,
-        status="settling",
-        settlement_time=None,
-        amount=req["amount"],
-        currency=req["currency"],
-        fx_rate=fx_rate,
-        converted_amount=converted_amount,
-        target_currency=target_currency
-    )
+    return {
+        "payment_id": payment_id,
+        "status": "settling",
+        "settlement_time": None,
+        "amount": payment.amount,
+        "currency": payment.currency,
+        "fx_rate": fx_rate,
+        "converted_amount": converted_amount,
+        "target_currency": target_currency
+    }
 
 @app.post("/v1/webhooks/register")
 
-def register_webhook(reg: WebhookRegistration, user: str = Depends(get_current_user)):
+async def register_webhook(reg: WebhookRegistration, user: str = Depends(get_current_user)):
     webhooks[reg.payment_id] = reg.url
     log_action(user, "register_webhook", {"payment_id": reg.payment_id, "url": reg.url})
     return {"result": "webhook registered"}
 
-# Token endpoint for demo (single user: demo/demo)
+# Token endpoint for demo (single user: demo/demo).
+# Credentials are compared as fixed-length SHA-256 digests via
+# hmac.compare_digest, so the check is constant-time with no early exit
+# on the first differing character.
+_USER_HASH = hashlib.sha256(b"demo").digest()
+_PASS_HASH = hashlib.sha256(b"demo").digest()
+
 @app.post("/v1/token")
-def login(form_data: OAuth2PasswordRequestForm = Depends()):
-    if form_data.username == "demo" and form_data.password == "demo":
+async def login(form_data: OAuth2PasswordRequestForm = Depends()):
+    user_ok = hmac.compare_digest(hashlib.sha256(form_data.username.encode()).digest(), _USER_HASH)
+    pass_ok = hmac.compare_digest(hashlib.sha256(form_data.password.encode()).digest(), _PASS_HASH)
+    if user_ok & pass_ok:
         access_token = create_access_token(
             data={"sub": form_data.username},
             expires_delta=timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)